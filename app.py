@@ -1,10 +1,11 @@
 import os
+import numpy as np
 import pandas as pd
 from openpyxl import load_workbook
-from openpyxl.styles import PatternFill
-from openpyxl.formatting.rule import CellIsRule
-from fuzzywuzzy import fuzz, process
+from rapidfuzz import fuzz, process
+from concurrent.futures import ThreadPoolExecutor
 import io
+import zipfile
 import streamlit as st
 import logging
 logging.basicConfig(level=logging.INFO)
@@ -26,64 +27,94 @@ column_mappings = {
     ]
 }
 
+inverse_column_mappings = {
+    old_name: new_name
+    for new_name, old_names in column_mappings.items()
+    for old_name in old_names
+}
+
+header_candidates = frozenset(inverse_column_mappings)
+
+# Shared formatting for flagged differences in the output workbooks
+red_format_spec = {'bg_color': '#FF0000'}
+difference_lower_threshold = -20
+difference_upper_threshold = 20
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def parse_uploaded_file(file_bytes, file_name):
+    """Parse one uploaded workbook into a single DataFrame, cached on the file bytes."""
+    workbook = load_workbook(io.BytesIO(file_bytes), read_only=True, data_only=True, keep_links=False)
+    sheet_frames = []
+    for worksheet in workbook.worksheets:
+        df = pd.DataFrame(list(worksheet.iter_rows(values_only=True)))
+        df = date_converter(df)
+        if not sheet_frames:
+            df = set_correct_headers(df, column_mappings)
+        else:
+            df.columns = sheet_frames[0].columns
+        sheet_frames.append(df)
+        logging.info(f"Read {file_name} - {worksheet.title} successfully with shape {df.shape}")
+    workbook.close()
+    all_sheets_df = pd.concat(sheet_frames, ignore_index=True) if sheet_frames else pd.DataFrame()
+    for column in all_sheets_df.columns:
+        if inverse_column_mappings.get(column, column) == 'Isin Code':
+            all_sheets_df[column] = all_sheets_df[column].astype('string[pyarrow]')
+    logging.info(f"Combined all sheets for {file_name} with shape {all_sheets_df.shape}")
+    return all_sheets_df
+
 def read_files_from_upload(uploaded_files):
-    """Read all uploaded files and return a dictionary of DataFrames."""
-    files_data = {}
-    for uploaded_file in uploaded_files:
+    """Read all uploaded files concurrently and return a dictionary of DataFrames."""
+    def read_one(uploaded_file):
         try:
-            excel_file = pd.ExcelFile(uploaded_file)
-            all_sheets_df = pd.DataFrame()
-            header_set = False
-            for sheet_name in excel_file.sheet_names:
-                df = pd.read_excel(uploaded_file, sheet_name=sheet_name, header=None)
-                df = date_converter(df)
-                if not header_set:
-                    df = set_correct_headers(df, column_mappings)
-                    header_set = True
-                else:
-                    df.columns = all_sheets_df.columns
-                all_sheets_df = pd.concat([all_sheets_df, df], ignore_index=True)
-                logging.info(f"Read {uploaded_file.name} - {sheet_name} successfully with shape {df.shape}")
-            files_data[uploaded_file.name] = all_sheets_df
-            logging.info(f"Combined all sheets for {uploaded_file.name} with shape {all_sheets_df.shape}")
+            return uploaded_file.name, parse_uploaded_file(uploaded_file.getvalue(), uploaded_file.name)
         except Exception as e:
             logging.error(f"Error reading {uploaded_file.name}: {e}")
-    return files_data
+            return uploaded_file.name, None
+
+    uploaded_files = list(uploaded_files)
+    if not uploaded_files:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(8, len(uploaded_files))) as executor:
+        results = list(executor.map(read_one, uploaded_files))
+    return {name: df for name, df in results if df is not None}
 
 def date_converter(df):
     if "Statement Month" in df.columns and "Statement Year" in df.columns:
-        df["Date"] = pd.to_datetime(df["Statement Month"].astype(str) + '-' + df["Statement Year"].astype(str), format='%m-%Y')
+        df["Date"] = pd.to_datetime({
+            'year': pd.to_numeric(df["Statement Year"], errors='coerce'),
+            'month': pd.to_numeric(df["Statement Month"], errors='coerce'),
+            'day': 1,
+        }, errors='coerce')
     return df
 
 def set_correct_headers(df, column_mappings):
     """Set the correct headers by finding the row that contains any of the mapped column names."""
-    for i, row in df.iterrows():
-        if any(header in row.values for headers in column_mappings.values() for header in headers):
-            df.columns = df.iloc[i]
-            df = df.drop(i).reset_index(drop=True)
-            return df
+    # Header rows live at the top of a sheet, so probe there before scanning everything
+    mask = df.head(32).isin(header_candidates).any(axis=1).to_numpy()
+    if not mask.any():
+        mask = df.isin(header_candidates).any(axis=1).to_numpy()
+    if mask.any():
+        i = int(mask.argmax())
+        df.columns = df.iloc[i]
+        df = df.iloc[i + 1:].reset_index(drop=True)
     return df
 
 def rename_columns(df, column_mappings):
     """Rename columns in the dataframe based on the provided mappings."""
-    rename_dict = {}
-    for new_name, old_names in column_mappings.items():
-        for old_name in old_names:
-            if old_name in df.columns:
-                rename_dict[old_name] = new_name
-    df.rename(columns=rename_dict, inplace=True)
+    df.rename(columns=inverse_column_mappings, inplace=True)
     return df
 
 def filter_valid_rows(df):
     """Filter rows that have both a valid ISIN code and a valid Date."""
     if 'Isin Code' in df.columns and 'Date' in df.columns:
-        df = df.dropna(subset=['Isin Code', 'Date'])
-        df = df[df['Isin Code'].apply(lambda x: isinstance(x, str) and x.strip() != "")]
+        isin = df['Isin Code'].astype('string')
+        mask = df['Date'].notna() & isin.notna() & isin.str.strip().ne("")
+        df = df[mask]
     return df
 
 def convert_date_column(df, date_column_name):
-    if date_column_name in df.columns:
-        df[date_column_name] = pd.to_datetime(df[date_column_name], errors='coerce', format='%d.%m.%Y')
+    if date_column_name in df.columns and not pd.api.types.is_datetime64_any_dtype(df[date_column_name]):
+        df[date_column_name] = pd.to_datetime(df[date_column_name], errors='coerce', format='%d.%m.%Y', cache=True)
     return df
 
 def aggregate_data(data, column_name):
@@ -91,9 +122,12 @@ def aggregate_data(data, column_name):
     aggregated_data = {}
     for file_name, df in data.items():
         df = rename_columns(df, column_mappings)
-        df = filter_valid_rows(df)
         if 'Isin Code' in df.columns and column_name in df.columns:
-            aggregated_df = df.groupby('Isin Code')[column_name].sum().reset_index()
+            df = df[['Isin Code', column_name]].dropna()
+            df = df[df['Isin Code'].astype('string').str.strip().ne("")]
+            df['Isin Code'] = df['Isin Code'].astype('category')
+            df[column_name] = pd.to_numeric(df[column_name], errors='coerce', downcast='float')
+            aggregated_df = df.groupby('Isin Code', as_index=False, sort=False, observed=True)[column_name].sum()
             aggregated_data[file_name] = aggregated_df
             logging.info(f"Aggregated {file_name} successfully with shape {aggregated_df.shape}")
         else:
@@ -102,13 +136,18 @@ def aggregate_data(data, column_name):
 
 def match_files(fundline_files, excel_files):
     """Match Fundline and Excel files based on similar names using fuzzy matching."""
+    fundline_files = list(fundline_files)
+    excel_files = list(excel_files)
     matched_files = []
-    for fundline_file in fundline_files:
-        fundline_base = os.path.splitext(fundline_file)[0].lower()
-        best_match, score = process.extractOne(fundline_base, [os.path.splitext(f)[0].lower() for f in excel_files], scorer=fuzz.partial_ratio)
-        if score > 80:  # Adjust this threshold based on your needs
-            excel_file = next(f for f in excel_files if os.path.splitext(f)[0].lower() == best_match)
-            matched_files.append((fundline_file, excel_file))
+    if fundline_files and excel_files:
+        fundline_bases = [os.path.splitext(f)[0].lower() for f in fundline_files]
+        excel_bases = [os.path.splitext(f)[0].lower() for f in excel_files]
+        # One batched call computes the full similarity matrix in parallel; scores below the cutoff are zeroed
+        scores = process.cdist(fundline_bases, excel_bases, scorer=fuzz.partial_ratio, score_cutoff=80, workers=-1)
+        for i, row in enumerate(scores):
+            j = int(row.argmax())
+            if row[j] > 80:  # Adjust this threshold based on your needs
+                matched_files.append((fundline_files[i], excel_files[j]))
     logging.info("Matched files: %s", matched_files)
     return matched_files
 
@@ -128,38 +167,56 @@ def compare_data(fundline_data, excel_data, column_mappings):
         fundline_df = rename_columns(fundline_df, column_mappings)
         excel_df = rename_columns(excel_df, column_mappings)
 
+        # Drop rows without a valid ISIN and Date before any grouping work
+        fundline_df = filter_valid_rows(fundline_df)
+        excel_df = filter_valid_rows(excel_df)
+
         # Convert date columns to datetime64[ns]
         fundline_df = convert_date_column(fundline_df, 'Date')
         excel_df = convert_date_column(excel_df, 'Date')
 
-        fundline_df = fundline_df.groupby(['Isin Code', 'Date'])['Erwartete Prov. Whg'].sum().reset_index()
-        excel_df = excel_df.groupby(['Isin Code', 'Date'])['Provision'].sum().reset_index()
-
         # Check if required columns are present
         if 'Isin Code' in fundline_df.columns and 'Date' in fundline_df.columns and 'Isin Code' in excel_df.columns and 'Date' in excel_df.columns:
-            # Merge dataframes on ISIN and Date with suffixes to handle common columns
-            comparison_df = pd.merge(
-                fundline_df, excel_df, 
-                left_on=['Isin Code', 'Date'], 
-                right_on=['Isin Code', 'Date'], 
-                how='inner', 
-                suffixes=('_Fundline', '_Excel')
+            # Nothing to group or join when either side lost all its rows in filtering
+            if fundline_df.empty or excel_df.empty:
+                logging.info(f"No valid rows to compare in {fundline_file} or {excel_file}")
+                continue
+
+            # Coerce the value columns once so everything downstream stays numeric
+            fundline_df['Erwartete Prov. Whg'] = pd.to_numeric(fundline_df['Erwartete Prov. Whg'], errors='coerce')
+            excel_df['Provision'] = pd.to_numeric(excel_df['Provision'], errors='coerce')
+
+            # Share one category set across both frames so grouping and joining run on integer codes
+            isin_categories = pd.api.types.union_categoricals(
+                [fundline_df['Isin Code'].astype('category'), excel_df['Isin Code'].astype('category')]
+            ).categories
+            fundline_df['Isin Code'] = fundline_df['Isin Code'].astype(pd.CategoricalDtype(isin_categories))
+            excel_df['Isin Code'] = excel_df['Isin Code'].astype(pd.CategoricalDtype(isin_categories))
+
+            # Group with sorted keys so both frames end up indexed by a sorted (Isin Code, Date) MultiIndex
+            fundline_df = fundline_df.groupby(['Isin Code', 'Date'], sort=True, observed=True)['Erwartete Prov. Whg'].sum().to_frame()
+            excel_df = excel_df.groupby(['Isin Code', 'Date'], sort=True, observed=True)['Provision'].sum().to_frame()
+
+            # Join on the shared sorted index instead of rebuilding merge keys
+            comparison_df = fundline_df.join(excel_df, how='inner').reset_index()
+
+            # No overlapping ISIN/Date pairs — skip the arithmetic and workbook generation
+            if comparison_df.empty:
+                logging.info(f"No overlapping rows found for {fundline_file} and {excel_file}")
+                continue
+
+            fundline_column = 'Erwartete Prov. Whg'
+            excel_column = 'Provision'
+
+            # Calculate differences in a single pass over the underlying numpy arrays
+            comparison_df['Difference'] = np.subtract(
+                comparison_df[excel_column].to_numpy(dtype=np.float64, copy=False),
+                comparison_df[fundline_column].to_numpy(dtype=np.float64, copy=False),
             )
 
-            # Identify the correct column names
-            fundline_column = 'Erwartete Prov. Whg_Fundline' if 'Erwartete Prov. Whg_Fundline' in comparison_df.columns else 'Erwartete Prov. Whg'
-            excel_column = 'Provision_Excel' if 'Provision_Excel' in comparison_df.columns else 'Provision'
-
-            # Ensure the columns being compared have the same type
-            comparison_df[fundline_column] = comparison_df[fundline_column].astype(float)
-            comparison_df[excel_column] = comparison_df[excel_column].astype(float)
-
-            # Calculate differences and add a new column for the difference
-            comparison_df['Difference'] = comparison_df[excel_column] - comparison_df[fundline_column]
-
             # Aggregate results for Quartal
-            fundline_quartal_agg = fundline_df.groupby('Isin Code')['Erwartete Prov. Whg'].sum().reset_index()
-            excel_quartal_agg = excel_df.groupby('Isin Code')['Provision'].sum().reset_index()
+            fundline_quartal_agg = fundline_df.groupby('Isin Code', sort=False, observed=True)['Erwartete Prov. Whg'].sum().reset_index()
+            excel_quartal_agg = excel_df.groupby('Isin Code', sort=False, observed=True)['Provision'].sum().reset_index()
             quartal_aggregated_df = pd.merge(
                 fundline_quartal_agg, excel_quartal_agg, 
                 on='Isin Code', 
@@ -169,45 +226,35 @@ def compare_data(fundline_data, excel_data, column_mappings):
             quartal_aggregated_df['Difference'] = quartal_aggregated_df['Provision'] - quartal_aggregated_df['Erwartete Prov. Whg']
 
             # Save each comparison result to a file
-            if not comparison_df.empty:
-                output = io.BytesIO()
+            output = io.BytesIO()
 
-                with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                    quartal_aggregated_df.to_excel(writer, sheet_name='Quartal', index=False)
-                    comparison_df[['Isin Code', 'Date', fundline_column, excel_column, 'Difference']].to_excel(writer, sheet_name='Einzeln', index=False)
+            with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
+                quartal_aggregated_df.to_excel(writer, sheet_name='Quartal', index=False)
+                comparison_df[['Isin Code', 'Date', fundline_column, excel_column, 'Difference']].to_excel(writer, sheet_name='Einzeln', index=False)
 
                 #appyling formatting if they are below or up certain value
-                apply_conditional_formatting(output, sheet_name='Quartal', column='D', lower_threshold=-20, upper_threshold=20)
-                apply_conditional_formatting(output, sheet_name='Einzeln', column='E', lower_threshold=-20, upper_threshold=20)
+                apply_conditional_formatting(writer, sheet_name='Quartal', column='D', n_rows=len(quartal_aggregated_df), lower_threshold=difference_lower_threshold, upper_threshold=difference_upper_threshold)
+                apply_conditional_formatting(writer, sheet_name='Einzeln', column='E', n_rows=len(comparison_df), lower_threshold=difference_lower_threshold, upper_threshold=difference_upper_threshold)
 
-                output.seek(0)
-                comparison_files.append((f"{os.path.splitext(fundline_file)[0]}_{os.path.splitext(excel_file)[0]}_comparison.xlsx", output))
-                logging.info(f"Saved comparison results to in-memory file for {fundline_file} and {excel_file}")
+            output.seek(0)
+            comparison_files.append((f"{os.path.splitext(fundline_file)[0]}_{os.path.splitext(excel_file)[0]}_comparison.xlsx", output))
+            logging.info(f"Saved comparison results to in-memory file for {fundline_file} and {excel_file}")
         else:
             logging.info(f"Required columns not found in {fundline_file} or {excel_file}")
 
     return comparison_files
 
-def apply_conditional_formatting(output, sheet_name='Sheet2', column='Difference', lower_threshold=None, upper_threshold=None):
-    """Apply conditional formatting to the Excel file for the specified column and range."""
-    output.seek(0)
-    wb = load_workbook(output)
-    ws = wb[sheet_name]
+def apply_conditional_formatting(writer, sheet_name='Sheet2', column='Difference', n_rows=0, lower_threshold=None, upper_threshold=None):
+    """Apply conditional formatting to the specified column while the workbook is still open."""
+    ws = writer.sheets[sheet_name]
+    red_format = writer.book.add_format(red_format_spec)
+    cell_range = f'{column}2:{column}{n_rows + 1}'
 
-    end_row = ws.max_row
-
-    red_fill = PatternFill(start_color="FF0000", end_color="FF0000", fill_type="solid")
-    
     if lower_threshold is not None:
-        lower_rule = CellIsRule(operator='lessThan', formula=[str(lower_threshold)], fill=red_fill)
-        ws.conditional_formatting.add(f'{column}2:{column}{end_row}', lower_rule)
+        ws.conditional_format(cell_range, {'type': 'cell', 'criteria': '<', 'value': lower_threshold, 'format': red_format})
 
     if upper_threshold is not None:
-        upper_rule = CellIsRule(operator='greaterThan', formula=[str(upper_threshold)], fill=red_fill)
-        ws.conditional_formatting.add(f'{column}2:{column}{end_row}', upper_rule)
-
-    output.seek(0)
-    wb.save(output)
+        ws.conditional_format(cell_range, {'type': 'cell', 'criteria': '>', 'value': upper_threshold, 'format': red_format})
 
 # Streamlit UI
 st.set_page_config(
@@ -231,9 +278,12 @@ if st.sidebar.button("Run Comparison"):
     if not fundline_files or not excel_files:
         st.error("Please upload files before running the comparison.")
     else:
-        # Read uploaded files
-        fundline_data = read_files_from_upload(fundline_files)
-        excel_data = read_files_from_upload(excel_files)
+        # Read uploaded files (both sides in parallel; each side fans out per file)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            fundline_future = executor.submit(read_files_from_upload, fundline_files)
+            excel_future = executor.submit(read_files_from_upload, excel_files)
+            fundline_data = fundline_future.result()
+            excel_data = excel_future.result()
 
         # Perform comparisons
         comparison_files = compare_data(fundline_data, excel_data, column_mappings)
@@ -241,10 +291,14 @@ if st.sidebar.button("Run Comparison"):
         # Show results
         if comparison_files:
             st.write("Comparison results:")
-            for file_name, file_data in comparison_files:
-                st.download_button(
-                    label=f"Download {file_name}", data=file_data, file_name=file_name
-                )
+            # One ZIP download instead of one button per file; each click reruns the whole script
+            zip_buffer = io.BytesIO()
+            with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as archive:
+                for file_name, file_data in comparison_files:
+                    archive.writestr(file_name, file_data.getvalue())
+            st.download_button(
+                label="Download all comparisons", data=zip_buffer.getvalue(), file_name="comparisons.zip", mime="application/zip"
+            )
         else:
             st.write("No discrepancies found.")
 